@@ -0,0 +1,51 @@
+# _openai.py
+"""
+Shared OpenAI clients so the whole process uses one pooled HTTP/2 connection pool.
+"""
+import asyncio
+import os
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+load_dotenv()
+
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = 30.0  # embeddings calls
+CHAT_TIMEOUT = 600.0  # non-streamed chat completions can take minutes (SDK default)
+
+# Embeddings client
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT),
+    timeout=HTTP_TIMEOUT
+)
+# Chat completions client: same connection pool, longer timeout
+chat_client = client.with_options(timeout=CHAT_TIMEOUT)
+
+# Async clients keep pooled connections tied to the event loop that opened them, so they
+# must not be shared across loops (e.g. separate asyncio.run() calls): one per running loop.
+# Clients of loops that have since closed are pruned on the next call.
+_async_clients = {}
+_closing_tasks = set()
+
+def _close_stale_client(loop, aclient):
+    """Close a client whose event loop has closed, ignoring errors from its dead connections."""
+    task = loop.create_task(aclient.close())
+    _closing_tasks.add(task)  # keep a reference until the task finishes
+    task.add_done_callback(lambda t: (_closing_tasks.discard(t), t.cancelled() or t.exception()))
+
+def get_async_client() -> AsyncOpenAI:
+    """Return the AsyncOpenAI client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    for stale_loop in [l for l in _async_clients if l.is_closed()]:
+        _close_stale_client(loop, _async_clients.pop(stale_loop))
+    
+    aclient = _async_clients.get(loop)
+    if aclient is None:
+        aclient = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+        _async_clients[loop] = aclient
+    return aclient
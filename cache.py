@@ -0,0 +1,103 @@
+# cache.py
+"""
+Persistent on-disk cache for embedding vectors.
+Vectors are keyed by sha256(model + "\\n" + text) and stored as float32 bytes in SQLite.
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite")
+
+_conn = None
+_lock = threading.Lock()
+
+def _get_connection() -> sqlite3.Connection:
+    """Open the cache database once per process and create the table if needed."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(EMBEDDING_CACHE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dim INTEGER, vec BLOB)"
+        )
+        _conn.commit()
+    return _conn
+
+def make_key(text: str, model: str) -> str:
+    """Build the cache key for a (text, model) pair."""
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+def get_many(texts: list[str], model: str) -> dict:
+    """Return {index: vector} for every text already present in the cache."""
+    keys = [make_key(text, model) for text in texts]
+    with _lock:
+        conn = _get_connection()
+        rows = {}
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows.update(conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", chunk
+            ).fetchall())
+    return {
+        i: np.frombuffer(rows[key], dtype=np.float32)
+        for i, key in enumerate(keys) if key in rows
+    }
+
+def put_many(texts: list[str], model: str, vectors) -> None:
+    """Store vectors for the given texts, leaving existing entries untouched."""
+    records = []
+    for text, vec in zip(texts, vectors):
+        arr = np.asarray(vec, dtype=np.float32)
+        records.append((make_key(text, model), arr.shape[0], arr.tobytes()))
+    with _lock:
+        conn = _get_connection()
+        conn.executemany("INSERT OR IGNORE INTO embeddings (key, dim, vec) VALUES (?, ?, ?)", records)
+        conn.commit()
+
+def _assemble(texts: list[str], cached: dict) -> np.ndarray:
+    """Stack {index: vector} into a (len(texts), dim) float32 array in input order."""
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    vectors = np.empty((len(texts), len(next(iter(cached.values())))), dtype=np.float32)
+    for i, vec in cached.items():
+        vectors[i] = vec
+    return vectors
+
+def get_or_compute_many(texts: list[str], model: str, fn) -> np.ndarray:
+    """
+    Return a (len(texts), dim) float32 array of vectors for texts,
+    calling fn(missing_texts) only for cache misses.
+    """
+    cached = get_many(texts, model)
+    missing = [i for i in range(len(texts)) if i not in cached]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        computed = np.asarray(fn(missing_texts), dtype=np.float32)
+        put_many(missing_texts, model, computed)
+        cached.update(zip(missing, computed))
+    return _assemble(texts, cached)
+
+async def aget_or_compute_many(texts: list[str], model: str, afn) -> np.ndarray:
+    """Async variant of get_or_compute_many; afn(missing_texts) is awaited for cache misses."""
+    # SQLite reads/commits take the shared lock and may fsync, so keep them off the event loop
+    cached = await asyncio.to_thread(get_many, texts, model)
+    missing = [i for i in range(len(texts)) if i not in cached]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        computed = np.asarray(await afn(missing_texts), dtype=np.float32)
+        await asyncio.to_thread(put_many, missing_texts, model, computed)
+        cached.update(zip(missing, computed))
+    return _assemble(texts, cached)
+
+def get_or_compute(text: str, model: str, fn) -> np.ndarray:
+    """Return the cached float32 vector for text, calling fn(text) on a cache miss."""
+    return get_or_compute_many([text], model, lambda missing: [fn(missing[0])])[0]
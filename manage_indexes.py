@@ -3,6 +3,7 @@ Helper script to manage ChromaDB collections.
 Use this to list, describe, or delete collections.
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import chromadb
 from chromadb.config import Settings
@@ -10,20 +11,41 @@ from chromadb.config import Settings
 load_dotenv()
 
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
+CHROMA_MODE = os.getenv("CHROMA_MODE", "embedded")
+CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
 
-if not os.path.exists(CHROMA_DB_PATH):
-    print(f"⚠️  ChromaDB path not found: {CHROMA_DB_PATH}")
-    print("   The database will be created when you first run vector_store.py")
-    print("   Or create the directory manually if needed.")
-    exit(1)
+if CHROMA_MODE == "server":
+    chroma_client = chromadb.HttpClient(
+        host=CHROMA_HOST,
+        port=CHROMA_PORT,
+        settings=Settings(anonymized_telemetry=False)
+    )
+else:
+    if not os.path.exists(CHROMA_DB_PATH):
+        print(f"⚠️  ChromaDB path not found: {CHROMA_DB_PATH}")
+        print("   The database will be created when you first run vector_store.py")
+        print("   Or create the directory manually if needed.")
+        exit(1)
+    
+    chroma_client = chromadb.PersistentClient(
+        path=CHROMA_DB_PATH,
+        settings=Settings(anonymized_telemetry=False)
+    )
 
-chroma_client = chromadb.PersistentClient(
-    path=CHROMA_DB_PATH,
-    settings=Settings(anonymized_telemetry=False)
-)
+def _collection_count(collection):
+    """Return (name, document count or error) for a collection."""
+    name = getattr(collection, "name", collection)
+    try:
+        # Newer ChromaDB versions return collection names from list_collections()
+        if isinstance(collection, str):
+            collection = chroma_client.get_collection(name=collection)
+        return name, collection.count()
+    except Exception as e:
+        return name, e
 
-def list_collections():
-    """List all collections."""
+def list_collections(with_counts: bool = False):
+    """List all collections. Document counts need one query per collection, so they are opt-in."""
     print("📋 Available ChromaDB Collections:\n")
     try:
         collections = chroma_client.list_collections()
@@ -32,15 +54,20 @@ def list_collections():
             print("   No collections found.")
             return
         
-        for collection in collections:
-            try:
-                count = collection.count()
-                print(f"   Name: {collection.name}")
-                print(f"   Document Count: {count}")
-                print()
-            except Exception as e:
-                print(f"   Name: {collection.name}")
-                print(f"   Error getting details: {e}")
+        if not with_counts:
+            for collection in collections:
+                print(f"   Name: {getattr(collection, 'name', collection)}")
+            print()
+            return
+        
+        # Count collections concurrently instead of one round-trip after another
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for name, count in executor.map(_collection_count, collections):
+                print(f"   Name: {name}")
+                if isinstance(count, Exception):
+                    print(f"   Error getting details: {count}")
+                else:
+                    print(f"   Document Count: {count}")
                 print()
     except Exception as e:
         print(f"❌ Error listing collections: {e}")
@@ -63,7 +90,10 @@ def describe_collection(collection_name: str):
         except Exception as e:
             print(f"   Could not get metadata info: {e}")
         
-        print(f"\n   Database Path: {os.path.abspath(CHROMA_DB_PATH)}")
+        if CHROMA_MODE == "server":
+            print(f"\n   Chroma server: {CHROMA_HOST}:{CHROMA_PORT}")
+        else:
+            print(f"\n   Database Path: {os.path.abspath(CHROMA_DB_PATH)}")
         
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -88,7 +118,7 @@ if __name__ == "__main__":
         command = sys.argv[1]
         
         if command == "list":
-            list_collections()
+            list_collections(with_counts="--counts" in sys.argv[2:])
         elif command == "describe" and len(sys.argv) > 2:
             describe_collection(sys.argv[2])
         elif command == "delete" and len(sys.argv) > 2:
@@ -97,12 +127,12 @@ if __name__ == "__main__":
             delete_collection(collection_name, confirm)
         else:
             print("Usage:")
-            print("  python manage_indexes.py list")
+            print("  python manage_indexes.py list [--counts]")
             print("  python manage_indexes.py describe <collection_name>")
             print("  python manage_indexes.py delete <collection_name> confirm")
     else:
         list_collections()
         print("\nUsage:")
-        print("  python manage_indexes.py list")
+        print("  python manage_indexes.py list [--counts]")
         print("  python manage_indexes.py describe <collection_name>")
         print("  python manage_indexes.py delete <collection_name> confirm")
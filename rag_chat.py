@@ -1,9 +1,7 @@
 import os
 import json
-from openai import OpenAI
 from retriever import retrieve_similar_chunks
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from _openai import chat_client as client
 
 def is_greeting(text):
     """Check if the user input is a greeting."""
@@ -1,77 +1,239 @@
+import asyncio
 import os
-from openai import OpenAI
+import threading
+import time
+from functools import lru_cache
+import numpy as np
 import chromadb
 from chromadb.config import Settings
 from dotenv import load_dotenv
+import cache as embedding_cache
+import _openai
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAI client (shared connection pool); async clients come from _openai.get_async_client()
+client = _openai.client
 
 # ChromaDB setup
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
 CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "medical-vectors")
+# "embedded" opens CHROMA_DB_PATH in-process; "server" connects to `chroma run --path ./chroma_db`
+CHROMA_MODE = os.getenv("CHROMA_MODE", "embedded")
+CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
+# Semantic query cache: near-duplicate queries reuse previous ChromaDB results
+SEMANTIC_CACHE_SIZE = 512  # 512 * 1536 dims * 4 bytes ≈ 3MB
+SEMANTIC_CACHE_THRESHOLD = 0.97  # minimum cosine similarity for a cache hit
+SEMANTIC_CACHE_TTL = 600  # seconds before a cached result is considered stale
+
+_semantic_vectors = None  # (SEMANTIC_CACHE_SIZE, dim) float32, L2-normalized rows
+_semantic_entries = []  # parallel to _semantic_vectors rows
+_semantic_lock = threading.Lock()
+
+# ChromaDB client and collection are opened once and reused for the process lifetime
+_chroma_client = None
+_collection = None
+_collection_lock = threading.Lock()
+
 def get_embedding(text, model=None):
-    """Generate embedding for query."""
+    """Generate embedding for query as a read-only float32 NumPy array."""
     if model is None:
         model = EMBEDDING_MODEL
-    text = text.replace("\n", " ")
-    response = client.embeddings.create(input=text, model=model)
-    return response.data[0].embedding
-
-def retrieve_similar_chunks(query, top_k=3):
-    """Retrieve top-k similar chunks for the given query using ChromaDB."""
-    # Check if ChromaDB path exists
-    if not os.path.exists(CHROMA_DB_PATH):
-        raise ValueError(f"ChromaDB path not found: {CHROMA_DB_PATH}. Please run vector_store.py first to create the database.")
-    
-    query_embedding = get_embedding(query)
+    text = text.strip()
+    return _embed_cached(text, model)
+
+@lru_cache(maxsize=2048)
+def _embed_cached(text, model):
+    """In-process memo of query embeddings as read-only float32 arrays, so cached values can be shared."""
+    vector = np.array(embedding_cache.get_or_compute(text, model, lambda t: _request_embedding(t, model)), dtype=np.float32)
+    vector.setflags(write=False)
+    return vector
+
+def get_embeddings(texts, model=None):
+    """Generate embeddings for several queries with at most one API call, as a (len(texts), dim) float32 array."""
+    if model is None:
+        model = EMBEDDING_MODEL
+    texts = [text.strip() for text in texts]
+    return embedding_cache.get_or_compute_many(texts, model, lambda missing: _request_embeddings(missing, model))
+
+async def aget_embeddings(texts, model=None):
+    """Async variant of get_embeddings using the AsyncOpenAI client."""
+    if model is None:
+        model = EMBEDDING_MODEL
+    texts = [text.strip() for text in texts]
+    return await embedding_cache.aget_or_compute_many(texts, model, lambda missing: _arequest_embeddings(missing, model))
+
+def _request_embedding(text, model):
+    """Call the OpenAI embeddings API for a single text."""
+    return _request_embeddings([text], model)[0]
+
+def _request_embeddings(texts, model):
+    """Call the OpenAI embeddings API for a list of texts in a single request."""
+    response = client.embeddings.create(input=texts, model=model)
+    return [d.embedding for d in response.data]
+
+async def _arequest_embeddings(texts, model):
+    """Call the OpenAI embeddings API for a list of texts without blocking the event loop."""
+    response = await _openai.get_async_client().embeddings.create(input=texts, model=model)
+    return [d.embedding for d in response.data]
+
+def _semantic_cache_lookup(query_vector, top_k):
+    """Return cached chunks for a near-duplicate query, or None on a miss."""
+    with _semantic_lock:
+        if not _semantic_entries:
+            return None
+        now = time.time()
+        similarities = _semantic_vectors[:len(_semantic_entries)] @ query_vector
+        for i, entry in enumerate(_semantic_entries):
+            # Ignore stale entries and ones retrieved with fewer results than requested
+            if now - entry["created"] > SEMANTIC_CACHE_TTL or entry["top_k"] < top_k:
+                similarities[i] = -1.0
+        best = int(np.argmax(similarities))
+        if similarities[best] <= SEMANTIC_CACHE_THRESHOLD:
+            return None
+        entry = _semantic_entries[best]
+        entry["last_used"] = now
+        return [dict(chunk) for chunk in entry["chunks"][:top_k]]
+
+def _semantic_cache_store(query_vector, top_k, chunks):
+    """Cache chunks for a query vector, evicting the least recently used entry when full."""
+    global _semantic_vectors
+    with _semantic_lock:
+        if _semantic_vectors is None or _semantic_vectors.shape[1] != query_vector.shape[0]:
+            _semantic_vectors = np.zeros((SEMANTIC_CACHE_SIZE, query_vector.shape[0]), dtype=np.float32)
+            _semantic_entries.clear()
+        now = time.time()
+        entry = {"top_k": top_k, "chunks": [dict(chunk) for chunk in chunks], "created": now, "last_used": now}
+        if len(_semantic_entries) < SEMANTIC_CACHE_SIZE:
+            slot = len(_semantic_entries)
+            _semantic_entries.append(entry)
+        else:
+            slot = min(range(len(_semantic_entries)), key=lambda i: _semantic_entries[i]["last_used"])
+            _semantic_entries[slot] = entry
+        _semantic_vectors[slot] = query_vector
+
+def _get_collection():
+    """Return the shared ChromaDB collection, opening the client on first use."""
+    global _chroma_client, _collection
+    if _collection is not None:
+        return _collection
+    with _collection_lock:
+        if _collection is None:
+            # Initialize ChromaDB client
+            if _chroma_client is None:
+                if CHROMA_MODE == "server":
+                    _chroma_client = chromadb.HttpClient(
+                        host=CHROMA_HOST,
+                        port=CHROMA_PORT,
+                        settings=Settings(anonymized_telemetry=False)
+                    )
+                else:
+                    # Check if ChromaDB path exists
+                    if not os.path.exists(CHROMA_DB_PATH):
+                        raise ValueError(f"ChromaDB path not found: {CHROMA_DB_PATH}. Please run vector_store.py first to create the database.")
+                    
+                    _chroma_client = chromadb.PersistentClient(
+                        path=CHROMA_DB_PATH,
+                        settings=Settings(anonymized_telemetry=False)
+                    )
+            
+            # Get collection
+            try:
+                _collection = _chroma_client.get_collection(name=CHROMA_COLLECTION_NAME)
+            except Exception as e:
+                raise ValueError(f"Collection '{CHROMA_COLLECTION_NAME}' not found. Please run vector_store.py first to create the collection. Error: {e}")
+    return _collection
+
+def retrieve_similar_chunks(queries, top_k=3):
+    """
+    Retrieve top-k similar chunks using ChromaDB.
+    Accepts a single query string (returns a list of chunks) or a list of queries
+    (returns one list of chunks per query, searched with a single ChromaDB call).
+    """
+    if isinstance(queries, str):
+        return _retrieve_batch([queries], top_k)[0]
+    return _retrieve_batch(list(queries), top_k)
+
+def _retrieve_batch(queries, top_k):
+    """Retrieve top-k chunks for each query, querying ChromaDB once for all semantic cache misses."""
+    collection = _get_collection()
+    if not queries:
+        return []
     
-    # Initialize ChromaDB client
-    chroma_client = chromadb.PersistentClient(
-        path=CHROMA_DB_PATH,
-        settings=Settings(anonymized_telemetry=False)
-    )
+    # A single query goes through the in-process memo; several are embedded in one request
+    if len(queries) == 1:
+        query_embeddings = [get_embedding(queries[0])]
+    else:
+        query_embeddings = list(get_embeddings(queries))
     
-    # Get collection
-    try:
-        collection = chroma_client.get_collection(name=CHROMA_COLLECTION_NAME)
-    except Exception as e:
-        raise ValueError(f"Collection '{CHROMA_COLLECTION_NAME}' not found. Please run vector_store.py first to create the collection. Error: {e}")
+    query_vectors, all_chunks, missing = _check_semantic_cache(query_embeddings, top_k)
+    if missing:
+        results = collection.query(**_query_args(query_embeddings, missing, top_k))
+        _fill_chunks(all_chunks, results, missing, query_vectors, top_k)
+    return all_chunks
+
+async def aretrieve_similar_chunks(queries, top_k=3):
+    """
+    Async variant of retrieve_similar_chunks for async web handlers: the embedding
+    call uses AsyncOpenAI and the ChromaDB query runs in a worker thread, so
+    concurrent requests don't block each other.
+    """
+    single = isinstance(queries, str)
+    queries = [queries] if single else list(queries)
     
-    # Query ChromaDB for similar vectors
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"]
-    )
+    collection = await asyncio.to_thread(_get_collection)
+    if not queries:
+        return []
     
-    # Format results to match the original structure
-    chunks = []
+    query_embeddings = list(await aget_embeddings(queries))
+    query_vectors, all_chunks, missing = _check_semantic_cache(query_embeddings, top_k)
+    if missing:
+        results = await asyncio.to_thread(collection.query, **_query_args(query_embeddings, missing, top_k))
+        _fill_chunks(all_chunks, results, missing, query_vectors, top_k)
+    return all_chunks[0] if single else all_chunks
+
+def _check_semantic_cache(query_embeddings, top_k):
+    """
+    Serve near-duplicate queries from the semantic cache.
+    Returns (normalized query vectors, chunks per query or None, indexes of cache misses).
+    """
+    query_vectors = [embedding / (np.linalg.norm(embedding) or 1.0) for embedding in query_embeddings]
+    all_chunks = [_semantic_cache_lookup(query_vector, top_k) for query_vector in query_vectors]
+    missing = [i for i, chunks in enumerate(all_chunks) if chunks is None]
+    return query_vectors, all_chunks, missing
+
+def _query_args(query_embeddings, missing, top_k):
+    """Build collection.query keyword arguments for the queries at the `missing` indexes."""
+    return {
+        "query_embeddings": [query_embeddings[i] for i in missing],
+        "n_results": top_k,
+        "include": ["documents", "distances"],  # metadatas aren't used, so don't fetch them
+    }
+
+def _fill_chunks(all_chunks, results, missing, query_vectors, top_k):
+    """Format ChromaDB results into all_chunks at the `missing` indexes and cache them."""
+    # ChromaDB returns one list of documents/distances per query embedding
+    documents_per_query = results["documents"] or [[] for _ in missing]
+    distances_per_query = results["distances"] or [[] for _ in missing]
     
-    # ChromaDB returns results in a nested structure
-    if results["documents"] and len(results["documents"]) > 0:
-        documents = results["documents"][0]  # First query result
-        metadatas = results["metadatas"][0] if results["metadatas"] else [{}] * len(documents)
-        distances = results["distances"][0] if results["distances"] else [0.0] * len(documents)
-        
-        for i, doc in enumerate(documents):
+    for i, documents, distances in zip(missing, documents_per_query, distances_per_query):
+        # Format results to match the original structure
+        chunks = []
+        for j, doc in enumerate(documents):
             # ChromaDB uses distance (lower is better), convert to similarity (higher is better)
             # For cosine distance: similarity = 1 - distance
-            distance = distances[i] if i < len(distances) else 1.0
+            distance = distances[j] if j < len(distances) else 1.0
             similarity = 1.0 - distance  # Convert distance to similarity
             
-            # Get text from document or metadata
-            text = doc
-            if not text and metadatas and i < len(metadatas):
-                # Fallback to metadata text if document is empty
-                text = metadatas[i].get("text", "")
-            
             chunks.append({
-                "text": text,
+                "text": doc or "",
                 "similarity": float(similarity)
             })
-    
-    return chunks
+        
+        # Don't cache empty results (e.g. before indexing finishes); they'd stick for the TTL
+        if chunks:
+            _semantic_cache_store(query_vectors[i], top_k, chunks)
+        all_chunks[i] = chunks
@@ -1,27 +1,94 @@
 # vector_store.py
+import hashlib
 import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from queue import Queue
+import threading
+import ijson
+import numpy as np
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 import chromadb
 from chromadb.config import Settings
+import cache as embedding_cache
+import _openai
 
 load_dotenv()
 
-# OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAI client (shared connection pool). SDK retries are off because
+# _request_embeddings_once retries with its own backoff; two layers would multiply attempts.
+client = _openai.client.with_options(max_retries=0)
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
 # ChromaDB setup
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
 CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "medical-vectors")
+# "embedded" opens CHROMA_DB_PATH in-process; "server" connects to `chroma run --path ./chroma_db`
+CHROMA_MODE = os.getenv("CHROMA_MODE", "embedded")
+CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
 
 INPUT_JSON = os.getenv("INPUT_JSON", "new_data.json")
 
-def build_text_for_embedding(doc: dict) -> str:
+# Documents per ChromaDB write; the server batches internally, so it can take larger writes
+CHROMA_BATCH_SIZE = int(os.getenv("CHROMA_BATCH_SIZE", "1000" if CHROMA_MODE == "server" else "250"))
+
+# Input limits of the text-embedding-3 models: tokens per input and per request
+MAX_EMBEDDING_TOKENS = 8191
+MAX_REQUEST_TOKENS = 300000
+# Character cutoff used instead when the tokenizer can't be loaded
+FALLBACK_MAX_CHARS = 6000
+
+# Optional product fields copied into ChromaDB metadata when present
+METADATA_KEYS = ("product_name", "therapeutic_class", "strength", "dosage_form")
+
+# Number of texts sent per embeddings request (API limit is 2048 inputs)
+EMBEDDING_BATCH_SIZE = 256
+# Number of embeddings requests in flight at once (I/O-bound, so threads are fine)
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "16"))
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """
+    Load the tokenizer for EMBEDDING_MODEL once per process.
+    tiktoken downloads its BPE file on first use (cached under TIKTOKEN_CACHE_DIR);
+    returns None if that fails so indexing can continue without exact token counts.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"⚠️  Could not load tokenizer for {EMBEDDING_MODEL}: {e}")
+        print(f"   Falling back to truncating texts at {FALLBACK_MAX_CHARS} characters")
+        return None
+
+def truncate_to_token_limit(text: str):
+    """Truncate text to MAX_EMBEDDING_TOKENS; returns (text, token count)."""
+    encoding = _get_encoding()
+    if encoding is None:
+        text = text[:FALLBACK_MAX_CHARS]
+        # The UTF-8 byte length is an upper bound on the token count
+        return text, len(text.encode("utf-8"))
+    # Treat special-token text such as "<|endoftext|>" in records as plain text
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) > MAX_EMBEDDING_TOKENS:
+        tokens = tokens[:MAX_EMBEDDING_TOKENS]
+        text = encoding.decode(tokens)
+    return text, len(tokens)
+
+def build_text_for_embedding(doc: dict):
     """
     Construct a single text blob from the Wockhardt product record.
     Uses available fields safely (some keys may not exist).
+    Returns (text, token count) so the count isn't recomputed when batching requests.
     """
     fields_in_order = [
         "product_name", "brand_name", "therapeutic_class", "strength",
@@ -37,19 +104,172 @@ def build_text_for_embedding(doc: dict) -> str:
     if not parts:
         parts.append(doc.get("id", ""))
     text_blob = "\n".join(parts).strip()
-    # keep it within a reasonable size for embeddings
-    return text_blob[:6000]
+    # keep it within the embedding model's token limit
+    return truncate_to_token_limit(text_blob)
+
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    wait=wait_exponential(multiplier=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+def _request_embeddings_once(texts: list[str]) -> list[list[float]]:
+    """Call the OpenAI embeddings API for a list of texts in a single request."""
+    resp = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    return [d.embedding for d in resp.data]
+
+def _request_embeddings(texts: list[str], token_counts: list[int]) -> list[list[float]]:
+    """Call the OpenAI embeddings API, splitting texts so no request exceeds MAX_REQUEST_TOKENS."""
+    embeddings = []
+    request, request_tokens = [], 0
+    for text, n_tokens in zip(texts, token_counts):
+        if request and request_tokens + n_tokens > MAX_REQUEST_TOKENS:
+            embeddings.extend(_request_embeddings_once(request))
+            request, request_tokens = [], 0
+        request.append(text)
+        request_tokens += n_tokens
+    if request:
+        embeddings.extend(_request_embeddings_once(request))
+    return embeddings
+
+def create_embeddings_batch(texts: list[str], token_counts: list[int] = None) -> np.ndarray:
+    """
+    Generate a (len(texts), dim) float32 array of embeddings for a list of texts,
+    only calling the API for uncached texts. Pass token_counts when already known.
+    """
+    if token_counts is None:
+        token_counts = [truncate_to_token_limit(text)[1] for text in texts]
+    # avoid empty input to embeddings API
+    texts = [text or " " for text in texts]
+    counts_by_text = dict(zip(texts, token_counts))
+    embeddings = None
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        chunk = embedding_cache.get_or_compute_many(
+            texts[i:i + EMBEDDING_BATCH_SIZE],
+            EMBEDDING_MODEL,
+            lambda missing: _request_embeddings(missing, [counts_by_text[text] for text in missing])
+        )
+        if embeddings is None:
+            embeddings = np.empty((len(texts), chunk.shape[1]), dtype=np.float32)
+        embeddings[i:i + len(chunk)] = chunk
+    return embeddings
 
-def create_embedding(text: str):
-    """Generate an embedding vector for a given text."""
-    if not text:
-        text = " "  # avoid empty input to embeddings API
-    resp = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
-    return resp.data[0].embedding
+def create_embedding(text: str) -> np.ndarray:
+    """Generate a float32 embedding vector for a given text."""
+    return create_embeddings_batch([text])[0]
 
-def clean_metadata(metadata: dict) -> dict:
-    """Remove None values from metadata dict. ChromaDB doesn't accept None values."""
-    return {k: v for k, v in metadata.items() if v is not None and v != ""}
+def prepare_record(i: int, doc: dict):
+    """Build the (id, metadata, document text, token count) record stored in ChromaDB for a product."""
+    uid = doc.get("id", f"vec_{i}")
+    title = doc.get("product_name") or doc.get("brand_name") or uid
+    source_id = doc.get("source_url") or ""  # Ensure it's never None
+    text, n_tokens = build_text_for_embedding(doc)
+    
+    # ChromaDB metadata - only include non-None, non-empty values (ChromaDB doesn't accept None)
+    metadata = {
+        "title": title or uid,  # Ensure title is never None/empty
+        "chunk_index": "0",
+        **({"source_id": source_id} if source_id else {}),
+        **{k: v for k in METADATA_KEYS if (v := doc.get(k))},
+    }
+    # Hash text and metadata together so re-runs also pick up metadata-only edits (e.g. source_url)
+    content = text + "\n" + json.dumps(metadata, sort_keys=True)
+    metadata["content_hash"] = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    
+    return uid, metadata, text, n_tokens
+
+def iter_batches(iterable, size: int):
+    """Yield lists of up to `size` items from any iterable without materializing it."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def filter_unchanged(collection, records: list, existing_ids: set) -> list:
+    """Drop records whose id is already indexed with the same content_hash."""
+    known_ids = [uid for uid, *_ in records if uid in existing_ids]
+    if not known_ids:
+        return records
+    stored = collection.get(ids=known_ids, include=["metadatas"])
+    stored_hashes = {
+        uid: (metadata or {}).get("content_hash")
+        for uid, metadata in zip(stored["ids"], stored["metadatas"])
+    }
+    return [
+        record for record in records
+        if stored_hashes.get(record[0]) != record[1]["content_hash"]
+    ]
+
+def produce_batches(collection, batch_queue: Queue, batch_size: int, stop_event: threading.Event, state: dict):
+    """
+    Producer: stream records from INPUT_JSON, embed new or changed ones in batches and push
+    (ids, embeddings, metadatas, documents) onto batch_queue, then a None sentinel.
+    """
+    processed = 0
+    skipped = 0
+    pending = deque()
+    # Each batch is embedded as separate EMBEDDING_BATCH_SIZE requests; only hold as many
+    # batches as it takes to keep EMBEDDING_WORKERS requests in flight
+    requests_per_batch = -(-batch_size // EMBEDDING_BATCH_SIZE)
+    max_pending = max(1, EMBEDDING_WORKERS // requests_per_batch)
+    try:
+        # One id-only fetch up front; metadatas are only fetched for batches with known ids
+        existing_ids = set(collection.get(include=[])["ids"]) if collection.count() else set()
+        with open(INPUT_JSON, "rb") as f, ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as executor:
+            # ijson yields one record at a time instead of materializing the whole list
+            doc_iter = ijson.items(f, "item", use_float=True)
+            for batch_docs in iter_batches(doc_iter, batch_size):
+                if stop_event.is_set():
+                    break
+                records = [prepare_record(processed + j, doc) for j, doc in enumerate(batch_docs)]
+                processed += len(records)
+                new_records = filter_unchanged(collection, records, existing_ids)
+                skipped += len(records) - len(new_records)
+                if not new_records:
+                    continue
+                records = new_records
+                ids, metadatas, documents, token_counts = (list(column) for column in zip(*records))
+                
+                futures = [
+                    executor.submit(
+                        create_embeddings_batch,
+                        documents[i:i + EMBEDDING_BATCH_SIZE],
+                        token_counts[i:i + EMBEDDING_BATCH_SIZE]
+                    )
+                    for i in range(0, len(documents), EMBEDDING_BATCH_SIZE)
+                ]
+                pending.append((ids, metadatas, documents, futures))
+                if len(pending) >= max_pending:
+                    ids, metadatas, documents, futures = pending.popleft()
+                    batch_queue.put((ids, np.concatenate([f.result() for f in futures]), metadatas, documents))
+            
+            while pending and not stop_event.is_set():
+                ids, metadatas, documents, futures = pending.popleft()
+                batch_queue.put((ids, np.concatenate([f.result() for f in futures]), metadatas, documents))
+    except Exception as e:
+        state["error"] = e
+    finally:
+        state["processed"] = processed
+        state["skipped"] = skipped
+        batch_queue.put(None)  # sentinel: no more batches
+
+def create_chroma_client():
+    """Create a ChromaDB client for the configured CHROMA_MODE."""
+    if CHROMA_MODE == "server":
+        # Client-server mode: the server owns the index, so writes don't re-persist it in-process
+        return chromadb.HttpClient(
+            host=CHROMA_HOST,
+            port=CHROMA_PORT,
+            settings=Settings(anonymized_telemetry=False)
+        )
+    
+    # Initialize ChromaDB client (persistent mode)
+    # Create directory if it doesn't exist
+    os.makedirs(CHROMA_DB_PATH, exist_ok=True)
+    
+    return chromadb.PersistentClient(
+        path=CHROMA_DB_PATH,
+        settings=Settings(anonymized_telemetry=False)
+    )
 
 def store_embeddings():
     """Store embeddings in ChromaDB collection."""
@@ -59,119 +279,85 @@ def store_embeddings():
     embedding_dimension = len(sample_embedding)
     print(f"✅ Embedding dimension: {embedding_dimension}")
     
-    # Initialize ChromaDB client (persistent mode)
-    # Create directory if it doesn't exist
-    os.makedirs(CHROMA_DB_PATH, exist_ok=True)
+    chroma_client = create_chroma_client()
     
-    chroma_client = chromadb.PersistentClient(
-        path=CHROMA_DB_PATH,
-        settings=Settings(anonymized_telemetry=False)
-    )
+    # Option: Clear existing collection if you want to rebuild
+    # Uncomment the next line if you want to rebuild from scratch (it is recreated just below)
+    # chroma_client.delete_collection(name=CHROMA_COLLECTION_NAME)
     
-    # Check if collection exists, get or create
-    try:
-        collection = chroma_client.get_collection(name=CHROMA_COLLECTION_NAME)
-        print(f"✅ Collection '{CHROMA_COLLECTION_NAME}' already exists")
-        
-        # Check if collection is empty or needs update
-        count = collection.count()
-        print(f"   Current document count: {count}")
-        
-        # Option: Clear existing collection if you want to rebuild
-        # Uncomment the next 2 lines if you want to rebuild from scratch
-        # chroma_client.delete_collection(name=CHROMA_COLLECTION_NAME)
-        # collection = chroma_client.create_collection(name=CHROMA_COLLECTION_NAME)
-        
-    except Exception:
-        # Collection doesn't exist, create it
-        print(f"Creating ChromaDB collection: {CHROMA_COLLECTION_NAME}")
-        collection = chroma_client.create_collection(
-            name=CHROMA_COLLECTION_NAME,
-            metadata={"hnsw:space": "cosine"}  # Use cosine similarity
-        )
-        print(f"✅ Collection {CHROMA_COLLECTION_NAME} created successfully!")
+    # Get or create the collection in one call. The HNSW parameters only apply when the
+    # collection is first created; retriever.py's collection.query uses them at search time.
+    collection = chroma_client.get_or_create_collection(
+        name=CHROMA_COLLECTION_NAME,
+        metadata={
+            "hnsw:space": "cosine",  # Use cosine similarity
+            "hnsw:construction_ef": 200,
+            "hnsw:M": 32,
+            "hnsw:search_ef": 100,  # never below chromadb's current default (100); older releases used 10
+        }
+    )
+    print(f"✅ Collection '{CHROMA_COLLECTION_NAME}' ready")
+    print(f"   Current document count: {collection.count()}")
     
-    # Load JSON
+    # Stream JSON
     if not os.path.exists(INPUT_JSON):
         raise FileNotFoundError(f"Input JSON not found: {INPUT_JSON}")
     
-    with open(INPUT_JSON, "r", encoding="utf-8") as f:
-        docs = json.load(f)
+    # Embed (producer thread) and add to ChromaDB (this thread) concurrently, so network
+    # and index writes overlap. At most about max(EMBEDDING_WORKERS * EMBEDDING_BATCH_SIZE,
+    # batch_size) documents are being embedded, plus 4 queued batches and 1 being written.
+    batch_size = CHROMA_BATCH_SIZE
+    batch_queue = Queue(maxsize=4)
+    stop_event = threading.Event()
+    state = {}
     
-    # Prepare data for ChromaDB
-    ids = []
-    embeddings = []
-    metadatas = []
-    documents = []
-    
-    print(f"\nProcessing {len(docs)} documents...")
+    print(f"\nProcessing documents from {INPUT_JSON} in batches of {batch_size}...")
     
-    for i, doc in enumerate(docs):
-        uid = doc.get("id", f"vec_{i}")
-        title = doc.get("product_name") or doc.get("brand_name") or uid
-        source_id = doc.get("source_url") or ""  # Ensure it's never None
-        text = build_text_for_embedding(doc)
-        embedding = create_embedding(text)
-        
-        # ChromaDB metadata - only include non-None, non-empty values
-        metadata = {
-            "title": title or uid,  # Ensure title is never None/empty
-            "chunk_index": "0",
-        }
-        
-        # Add source_id only if it exists
-        if source_id:
-            metadata["source_id"] = source_id
-        
-        # Add optional fields only if they exist and are not None/empty
-        if doc.get("product_name"):
-            metadata["product_name"] = doc.get("product_name")
-        if doc.get("therapeutic_class"):
-            metadata["therapeutic_class"] = doc.get("therapeutic_class")
-        if doc.get("strength"):
-            metadata["strength"] = doc.get("strength")
-        if doc.get("dosage_form"):
-            metadata["dosage_form"] = doc.get("dosage_form")
-        
-        # Clean metadata to remove any None or empty values
-        metadata = clean_metadata(metadata)
-        
-        ids.append(uid)
-        embeddings.append(embedding)
-        metadatas.append(metadata)
-        documents.append(text)
-        
-        # Progress indicator
-        if (i + 1) % 100 == 0:
-            print(f"   Processed {i + 1}/{len(docs)} documents...")
+    producer = threading.Thread(
+        target=produce_batches,
+        args=(collection, batch_queue, batch_size, stop_event, state),
+        daemon=True
+    )
+    producer.start()
     
-    # Batch add to ChromaDB (ChromaDB handles batching internally, but we can do it manually for large datasets)
-    batch_size = 100
-    total_batches = (len(ids) + batch_size - 1) // batch_size
+    batch_num = 0
+    try:
+        while (batch := batch_queue.get()) is not None:
+            batch_ids, batch_embeddings, batch_metadatas, batch_documents = batch
+            # upsert so changed records replace their previous version
+            collection.upsert(
+                ids=batch_ids,
+                embeddings=batch_embeddings,
+                metadatas=batch_metadatas,
+                documents=batch_documents
+            )
+            
+            batch_num += 1
+            print(f"   Added batch {batch_num} ({len(batch_ids)} documents)")
+    except BaseException:
+        # Stop the producer and drain the queue so it never blocks on a full queue
+        # (BaseException so Ctrl-C doesn't leave producer.join() waiting on a blocked put)
+        stop_event.set()
+        while batch_queue.get() is not None:
+            pass
+        raise
+    finally:
+        producer.join()
     
-    print(f"\nAdding documents to ChromaDB in {total_batches} batches...")
+    if "error" in state:
+        raise state["error"]
     
-    for i in range(0, len(ids), batch_size):
-        batch_ids = ids[i:i + batch_size]
-        batch_embeddings = embeddings[i:i + batch_size]
-        batch_metadatas = metadatas[i:i + batch_size]
-        batch_documents = documents[i:i + batch_size]
-        
-        collection.add(
-            ids=batch_ids,
-            embeddings=batch_embeddings,
-            metadatas=batch_metadatas,
-            documents=batch_documents
-        )
-        
-        batch_num = i // batch_size + 1
-        print(f"   Added batch {batch_num}/{total_batches} ({len(batch_ids)} documents)")
+    print(f"   Processed {state['processed']} documents in {batch_num} batches")
+    print(f"   Skipped {state['skipped']} unchanged documents")
     
     # Verify final count
     final_count = collection.count()
     print(f"\n✅ All embeddings stored successfully in ChromaDB!")
     print(f"   Total documents in collection: {final_count}")
-    print(f"   Collection path: {os.path.abspath(CHROMA_DB_PATH)}")
+    if CHROMA_MODE == "server":
+        print(f"   Chroma server: {CHROMA_HOST}:{CHROMA_PORT}")
+    else:
+        print(f"   Collection path: {os.path.abspath(CHROMA_DB_PATH)}")
 
 if __name__ == "__main__":
     store_embeddings()